@@ -1,12 +1,50 @@
 import streamlit as st
+import asyncio
+import hashlib
+import hmac
 import json
+import math
 import re
+import sqlite3
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from google import genai
-from PIL import Image
-from pypdf import PdfReader
-from datetime import datetime
+from pydantic import BaseModel
+from datetime import datetime, timezone
 import os
-import pandas as pd
+
+# pandas, PIL and the PDF backends are imported lazily inside the code
+# paths that need them: every Streamlit rerun re-executes this module, and
+# paying ~100-300ms of import cost on the login screen serves nobody.
+
+# Rust-backed orjson is 3-10x faster than the stdlib at (de)serializing
+# the nested history/profile dicts; fall back to json when not installed.
+try:
+    import orjson
+
+    def jdumps(obj, indent=False):
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(obj, default=str, option=option).decode()
+
+    jloads = orjson.loads
+except ImportError:
+    def jdumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None, default=str)
+
+    jloads = json.loads
+
+@st.cache_data(show_spinner=False)
+def export_json(history):
+    """Pretty-printed JSON for the download buttons, keyed on content.
+
+    The cache is process-global, so the entries themselves must be the
+    key: a length-based key collides across the three histories and
+    across concurrently logged-in users, and stops changing once a
+    bounded deque rotates. Hashing the entries is still far cheaper
+    than the pretty-printed dump this memoizes.
+    """
+    return jdumps(history, indent=True)
 
 # --------------------------------------------------
 # PAGE CONFIG (Only call once!)
@@ -21,127 +59,667 @@ st.set_page_config(
 # --------------------------------------------------
 # CUSTOM CSS
 # --------------------------------------------------
-st.markdown("""
-<style>
-    .main-header {
-        font-size: 2.8rem;
-        font-weight: bold;
-        text-align: center;
-        background: linear-gradient(120deg, #84fab0 0%, #8fd3f4 100%);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-        padding: 1rem 0;
-    }
-    .info-card {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        padding: 1.5rem;
-        border-radius: 15px;
-        color: white;
-        margin: 1rem 0;
-    }
-    .metric-box {
-        background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%);
-        padding: 1rem;
-        border-radius: 10px;
-        text-align: center;
-        color: white;
-    }
-    .stButton>button {
-        width: 100%;
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        border-radius: 10px;
-        font-weight: bold;
-        border: none;
-        transition: all 0.3s;
-    }
-    .stButton>button:hover {
-        transform: scale(1.02);
-        box-shadow: 0 5px 20px rgba(102, 126, 234, 0.4);
-    }
-    .warning-box {
-        background: linear-gradient(135deg, #ff6b6b 0%, #ffa500 100%);
-        padding: 1rem;
-        border-radius: 10px;
-        color: white;
-        margin: 0.5rem 0;
-    }
-    .success-box {
-        background: linear-gradient(135deg, #11998e 0%, #38ef7d 100%);
-        padding: 1rem;
-        border-radius: 10px;
-        color: white;
-        margin: 0.5rem 0;
-    }
-    .tab-content {
-        padding: 1rem 0;
-    }
-</style>
-""", unsafe_allow_html=True)
+# Styles live in static/app.css (served through Streamlit static hosting,
+# see .streamlit/config.toml). Re-emitting a one-line <link> per rerun is
+# far cheaper than re-sending and re-diffing the full inline style block.
+st.markdown('<link rel="stylesheet" href="./app/static/app.css">', unsafe_allow_html=True)
 
 # --------------------------------------------------
 # HELPER FUNCTIONS
 # --------------------------------------------------
+CACHE_DIR = "cache"
+
+# Uploads with at least this many images take the map-reduce path: one
+# concurrent ingredient-detection call per image, then a single
+# text-only fusion call. Below it, all images go into one multimodal
+# call.
+MAP_REDUCE_MIN_IMAGES = 4
+
+# PDFs above this page count are not parsed eagerly; the user picks a
+# page range instead, keeping memory bounded on huge uploads.
+MAX_EAGER_PAGES = 200
+
+# Session histories keep at most this many entries; each one can hold a
+# multi-KB analysis, and session_state is pickled per rerun, so an
+# unbounded list grows both RAM and rerun latency over a long session.
+# Note: once a deque is full, appends rotate the oldest entry out and
+# the length stops changing — anything derived from a history must key
+# on its entries (as export_json/build_marker_frame do), never on len().
+HISTORY_MAXLEN = 50
+
+# Compiled once at import time; these run inside loops over history and on
+# every Gemini response, so the per-call pattern-cache lookup adds up.
+_NUM_RE = re.compile(r"[-+]?\d*\.\d+|\d+")
+_JSON_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.M)
+_JSON_OBJ_RE = re.compile(r"\{[\s\S]*\}")
+
 def extract_numeric(text):
-    """Extracts the first numeric value from a string."""
-    match = re.search(r"[-+]?\d*\.\d+|\d+", str(text))
+    """Extract the first numeric value from a scalar string.
+
+    Fallback for one-off values only: columns go through the vectorized
+    str.extract pass in _flatten_markers, which runs _NUM_RE once over
+    the whole column instead of once per row.
+    """
+    match = _NUM_RE.search(str(text))
     return float(match.group()) if match else None
 
-def load_users():
-    """Load users from JSON file."""
-    if os.path.exists("users.json"):
-        try:
-            with open("users.json") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return {}
-    return {}
+def _hash_password(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1)
+
+def add_user(con, name, password):
+    """Insert a user with a fresh salt and scrypt hash."""
+    salt = os.urandom(16)
+    con.execute(
+        "INSERT OR IGNORE INTO users VALUES (?, ?, ?)",
+        (name, salt, _hash_password(password, salt))
+    )
+    con.commit()
+
+def user_exists(con, name):
+    return con.execute("SELECT 1 FROM users WHERE name = ?", (name,)).fetchone() is not None
+
+def verify_user(con, name, password):
+    row = con.execute("SELECT salt, pwhash FROM users WHERE name = ?", (name,)).fetchone()
+    return row is not None and hmac.compare_digest(row[1], _hash_password(password, row[0]))
+
+def _migrate_legacy_users(con):
+    """One-time import of the old plaintext users.json, if present."""
+    if not os.path.exists("users.json"):
+        return
+    try:
+        with open("users.json") as f:
+            legacy = jloads(f.read())
+    except (OSError, json.JSONDecodeError):
+        return
+    for name, password in legacy.items():
+        add_user(con, name, password)
+    os.replace("users.json", "users.json.migrated")
 
-def save_users(users):
-    """Save users to JSON file."""
-    with open("users.json", "w") as f:
-        json.dump(users, f)
+@st.cache_resource
+def user_db():
+    """Open the credential store once per process.
+
+    SQLite gives an indexed O(1) lookup per login instead of re-reading and
+    re-parsing a JSON blob on every Streamlit rerun, and passwords are kept
+    as salted scrypt hashes rather than plaintext.
+    """
+    con = sqlite3.connect("users.db", check_same_thread=False)
+    con.execute("CREATE TABLE IF NOT EXISTS users(name TEXT PRIMARY KEY, salt BLOB, pwhash BLOB)")
+    con.commit()
+    _migrate_legacy_users(con)
+    return con
+
+@st.cache_resource
+def history_db():
+    """Open the per-user analysis history store once per process.
+
+    Histories previously lived only in session_state and vanished on
+    reconnect, forcing users to re-run (and re-pay for) old analyses.
+    One table keyed on (username, kind) holds the entries as JSON blobs;
+    rows are written once on append and read once per session.
+    """
+    con = sqlite3.connect("history.db", check_same_thread=False)
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS history(username TEXT, kind TEXT, ts TEXT, entry TEXT)"
+    )
+    con.commit()
+    return con
+
+def append_history(kind, entry):
+    """Append an entry to the session history and persist it."""
+    st.session_state[f"{kind}_history"].append(entry)
+    con = history_db()
+    con.execute(
+        "INSERT INTO history VALUES (?, ?, ?, ?)",
+        (st.session_state.username, kind, entry["timestamp"], jdumps(entry)),
+    )
+    con.commit()
+
+def load_history(kind):
+    """Rehydrate one history deque for the logged-in user."""
+    rows = history_db().execute(
+        "SELECT entry FROM history WHERE username = ? AND kind = ? ORDER BY ts",
+        (st.session_state.username, kind),
+    ).fetchall()
+    return deque((jloads(row[0]) for row in rows), maxlen=HISTORY_MAXLEN)
+
+def _drop_history(kind):
+    con = history_db()
+    con.execute(
+        "DELETE FROM history WHERE username = ? AND kind = ?",
+        (st.session_state.username, kind),
+    )
+    con.commit()
+
+def _entry_key(prefix, entry, seen):
+    """Stable widget key for one history entry.
+
+    Positional indexes re-map to different records whenever the deque
+    grows or rotates, silently re-binding an open toggle to another
+    entry's body; keying on the entry content keeps toggle state
+    attached to its record. seen counts duplicates within one render so
+    two identical entries still get distinct widget keys.
+    """
+    digest = hashlib.blake2b(jdumps(entry).encode(), digest_size=8).hexdigest()
+    n = seen.get(digest, 0)
+    seen[digest] = n + 1
+    return f"{prefix}_{digest}" if n == 0 else f"{prefix}_{digest}_{n}"
+
+# Button callbacks: these run just before Streamlit's implicit rerun, so
+# mutating session state here needs no explicit st.rerun() - the old
+# pattern triggered a second full script execution per click.
+def _logout():
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+
+def _clear_profile():
+    st.session_state.clinical_data = None
+    st.session_state.health_ctx_str = ""
+
+def _clear_reports():
+    st.session_state.clinical_history = deque(maxlen=HISTORY_MAXLEN)
+    st.session_state.clinical_data = None
+    st.session_state.health_ctx_str = ""
+    _drop_history("clinical")
+    # Also drop the on-disk marker store: leaving it would keep the
+    # user's medical data on disk and rehydrate the trends chart right
+    # after they asked for it to be cleared.
+    try:
+        os.remove(_marker_store_path(st.session_state.username))
+    except FileNotFoundError:
+        pass
+
+def _clear_recipes():
+    st.session_state.recipe_history = deque(maxlen=HISTORY_MAXLEN)
+    st.session_state.pop("last_recipe", None)
+    _drop_history("recipe")
+
+def _clear_scans():
+    st.session_state.product_scan_history = deque(maxlen=HISTORY_MAXLEN)
+    st.session_state.pop("last_scan", None)
+    _drop_history("product_scan")
+
+def _health_context(clinical_data):
+    """Compact health-context JSON for the recipe and label prompts.
+
+    The full extraction carries a prose summary the downstream prompts
+    don't use; keeping only conditions, medications, and lab markers
+    trims the tokens re-sent with every recipe and label call. The
+    result is serialized once per profile update (stored in
+    session_state), not per Analyze click.
+    """
+    if not clinical_data:
+        return ""
+    trimmed = {
+        key: clinical_data[key]
+        for key in ("conditions", "medications", "lab_markers")
+        if clinical_data.get(key)
+    }
+    return jdumps(trimmed)
 
 def clean_json_response(text):
     """Clean JSON from Gemini response."""
-    # Remove markdown code blocks
-    clean = re.sub(r"```json\s*", "", text)
-    clean = re.sub(r"```\s*", "", clean)
-    clean = clean.strip()
-    
-    # Try to find JSON object in the text
-    json_match = re.search(r'\{[\s\S]*\}', clean)
-    if json_match:
-        clean = json_match.group()
-    
-    return json.loads(clean)
+    # One anchored pass strips both opening and closing fences; only fall
+    # back to the object search when the result isn't already a bare object.
+    clean = _JSON_FENCE_RE.sub("", text).strip()
+    if not clean.startswith("{"):
+        json_match = _JSON_OBJ_RE.search(clean)
+        if json_match:
+            clean = json_match.group()
+
+    return jloads(clean)
+
+def _load_pdfium():
+    try:
+        import pypdfium2 as pdfium  # C-backed PDFium, ~5-10x faster text extraction
+        return pdfium
+    except ImportError:
+        return None
+
+def _extract_page_range(path, start, stop):
+    """Extract text for a block of pages; runs inside a worker process.
+
+    Prefers pypdfium2 (compute happens in PDFium's C code) and falls back
+    to pypdf's pure-Python extractor when pypdfium2 is unavailable.
+    """
+    pdfium = _load_pdfium()
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return "\n".join(pdf[i].get_textpage().get_text_range() for i in range(start, stop))
+        finally:
+            pdf.close()
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return "\n".join(reader.pages[i].extract_text() or "" for i in range(start, stop))
+
+def pdf_page_count(raw_bytes):
+    """Probe the number of pages without extracting any text."""
+    pdfium = _load_pdfium()
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(raw_bytes)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    import io
+    from pypdf import PdfReader
+    return len(PdfReader(io.BytesIO(raw_bytes), strict=False).pages)
+
+def extract_pdf_text(raw_bytes, page_range=None):
+    """Extract text from a PDF, parallelizing across page ranges.
+
+    pypdf's extractor is CPU-bound per page and pages are independent, so
+    large documents are split into one block of pages per worker process.
+    Small documents stay single-process to avoid pool spawn overhead.
+    page_range, when given, is a (start, stop) half-open page span.
+    """
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(raw_bytes)
+        path = tmp.name
 
-def get_barcode_via_ai(client, model_id, image):
-    """Use Gemini to read barcode from image."""
     try:
-        prompt = """Look at this image carefully. If there is a barcode or QR code visible:
+        n_pages = pdf_page_count(raw_bytes)
+        start, stop = 0, n_pages
+        if page_range is not None:
+            start = max(page_range[0], 0)
+            stop = min(page_range[1], n_pages)
+        span = stop - start
+        workers = min(os.cpu_count() or 1, span)
+
+        if span <= 4 or workers <= 1:
+            return _extract_page_range(path, start, stop)
+
+        block = math.ceil(span / workers)
+        ranges = [(i, min(i + block, stop)) for i in range(start, stop, block)]
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            parts = ex.map(
+                _extract_page_range,
+                [path] * len(ranges),
+                [r[0] for r in ranges],
+                [r[1] for r in ranges]
+            )
+            return "\n".join(parts)
+    finally:
+        os.unlink(path)
+
+@st.cache_data(show_spinner=False)
+def analyze_report(_client, model_id, content_hash, prompt, _content, _config=None):
+    """Run the medical extraction for a report, cached by content hash.
+
+    Identical uploads short-circuit the Gemini call entirely: first via
+    Streamlit's in-memory cache (keyed on content_hash + prompt), then via
+    a JSON file on disk that survives process restarts. The disk filename
+    folds in model_id and prompt alongside the content hash — a change to
+    either must invalidate old entries, not keep serving their output.
+    """
+    variant = hashlib.blake2b(
+        f"{model_id}|{prompt}".encode(), digest_size=8
+    ).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{content_hash}-{variant}.json")
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                return jloads(f.read())
+        except (OSError, json.JSONDecodeError):
+            pass
+
+    response = _client.models.generate_content(
+        model=model_id,
+        contents=[prompt, _content],
+        config=_config
+    )
+    # JSON mode populates response.parsed with the schema instance; fall
+    # back to fence-stripping for configs without a response_schema.
+    parsed = getattr(response, "parsed", None)
+    if parsed is not None:
+        extracted = parsed.model_dump()
+    else:
+        extracted = clean_json_response(response.text)
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_path, "w") as f:
+            f.write(jdumps(extracted))
+    except OSError:
+        pass
+
+    return extracted
+
+def generate_parallel(client, model_id, contents_list, config=None, configs=None):
+    """Run several generate_content requests concurrently via the async client.
+
+    Each entry in contents_list is one full `contents` payload. The requests
+    are network-bound, so gathering them overlaps upload + model compute
+    instead of paying each round-trip sequentially. `config` applies to
+    every request; `configs` supplies one config per payload for mixed
+    batches (e.g. only one request using a server-side prompt cache).
+    """
+    if configs is None:
+        configs = [config] * len(contents_list)
+
+    async def _gather():
+        aclient = client.aio
+        coros = [
+            aclient.models.generate_content(model=model_id, contents=contents, config=cfg)
+            for contents, cfg in zip(contents_list, configs)
+        ]
+        return await asyncio.gather(*coros)
+
+    return asyncio.run(_gather())
+
+def _flatten_markers(history):
+    """Flatten history entries into a long-form marker DataFrame.
+
+    Numeric parsing runs as one vectorized str.extract pass over the whole
+    column instead of a re.search per value.
+    """
+    import pandas as pd
+
+    rows = [
+        (entry["timestamp"], name.lower().strip(), value)
+        for entry in history
+        for name, value in entry["data"].get("lab_markers", {}).items()
+    ]
+    df = pd.DataFrame(rows, columns=["Date", "Marker", "Raw"])
+    if df.empty:
+        return df.assign(Value=pd.Series(dtype=float))
+    df["Value"] = df["Raw"].astype(str).str.extract(f"({_NUM_RE.pattern})")[0].astype(float)
+    # One vectorized conversion (cache=True dedupes repeated strings);
+    # format="mixed" also accepts the pre-ISO timestamps in old stores.
+    df["Date"] = pd.to_datetime(df["Date"], utc=True, cache=True, format="mixed")
+    return df.dropna(subset=["Value"])
+
+@st.cache_data(show_spinner=False)
+def build_marker_frame(history):
+    """Cached flatten of the session history, keyed on its entries.
+
+    The cache is shared across sessions, so the entries themselves must
+    be the key: a bare length collides between users with equally sized
+    histories and stops changing once the bounded deque rotates. Repeat
+    reruns with an unchanged history still resolve to a hash plus a
+    dict lookup instead of the pandas flatten.
+    """
+    return _flatten_markers(history)
+
+@st.cache_data(show_spinner=False)
+def marker_index(df):
+    """Group the combined marker frame by marker, once per distinct frame.
+
+    Changing the trend selectbox then resolves to a dict lookup instead of
+    a full-frame boolean scan plus sort on every rerun. The frame itself
+    is the cache key: a proxy key (history length + store mtime) collides
+    across users in this process-global cache — two sessions without a
+    parquet store both see mtime 0, and equal history lengths would then
+    serve one user's lab markers to the other.
+    """
+    return {marker: group.sort_values("Date") for marker, group in df.groupby("Marker")}
+
+# Series at or above this length are downsampled before charting.
+CHART_MAX_POINTS = 200
+
+def _lttb_downsample(df, n_out=CHART_MAX_POINTS):
+    """Largest-triangle-three-buckets downsampling for the trend chart.
+
+    st.line_chart ships every row to the browser and Vega-Lite render
+    time grows with point count; LTTB keeps the visual shape of the
+    series with a bounded number of points. Implemented over NumPy
+    directly rather than pulling in the lttb package for ~20 lines.
+    """
+    import numpy as np
+
+    n = len(df)
+    if n <= n_out:
+        return df
+    x = df["Date"].astype("int64").to_numpy(dtype=float)
+    y = df["Value"].to_numpy(dtype=float)
+    bounds = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = [0]
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = bounds[i], max(bounds[i + 1], bounds[i] + 1)
+        if i < n_out - 3:
+            nstart, nstop = bounds[i + 1], max(bounds[i + 2], bounds[i + 1] + 1)
+            next_x, next_y = x[nstart:nstop].mean(), y[nstart:nstop].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        # Triangle area of each candidate with the last kept point and
+        # the next bucket's average; keep the largest.
+        area = np.abs(
+            (x[a] - next_x) * (y[start:stop] - y[a])
+            - (x[a] - x[start:stop]) * (next_y - y[a])
+        )
+        a = start + int(area.argmax())
+        keep.append(a)
+    keep.append(n - 1)
+    return df.iloc[keep]
+
+def _marker_store_path(username):
+    return os.path.join(CACHE_DIR, username, "markers.parquet")
+
+def persist_markers(username, df):
+    """Append one report's marker frame to the on-disk Parquet store."""
+    import pandas as pd
+
+    if df.empty:
+        return
+    path = _marker_store_path(username)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            df = pd.concat([pd.read_parquet(path), df], ignore_index=True)
+        df.to_parquet(path, index=False)
+    except Exception:
+        pass  # no parquet engine / unwritable disk; session data still works
+
+@st.cache_data(show_spinner=False)
+def _read_marker_store(path, mtime):
+    import pandas as pd
+
+    return pd.read_parquet(path)
+
+def load_marker_store(username):
+    """Rehydrate markers extracted in previous sessions (cached on mtime)."""
+    import pandas as pd
+
+    path = _marker_store_path(username)
+    if os.path.exists(path):
+        try:
+            return _read_marker_store(path, os.path.getmtime(path))
+        except Exception:
+            pass
+    return pd.DataFrame(columns=["Date", "Marker", "Raw"]).assign(Value=pd.Series(dtype=float))
+
+def prep_for_gemini(img):
+    """Downscale and JPEG-re-encode an image before sending to Gemini.
+
+    Phone photos are often 4000x3000 and 8-10 MB; upload time and vision
+    tokens both scale with pixel count, and the model downsamples
+    internally anyway. 1024px longest edge at JPEG q85 cuts the payload
+    roughly 10-20x with no practical loss for ingredient detection.
+
+    Returns the encoded JPEG bytes, not a PIL image: downstream the
+    bytes are wrapped in genai.types.Part.from_bytes, so the SDK ships
+    them as-is instead of re-encoding a decoded pixel buffer.
+    """
+    import io
+    from PIL import Image
+
+    im = img.copy()
+    im.thumbnail((1024, 1024), Image.LANCZOS)
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False)
+def decode_thumb(raw):
+    """Fast, small decode for display only.
+
+    Image.draft lets libjpeg skip most DCT blocks during decode, so a
+    ~512px preview costs a fraction of a full-resolution decode and never
+    materializes the full pixel buffer in RAM.
+    """
+    import io
+    from PIL import Image
+
+    im = Image.open(io.BytesIO(raw))
+    im.draft("RGB", (512, 512))
+    im.load()
+    return im
+
+@st.cache_data(show_spinner=False)
+def decode_image(raw):
+    """Downscale an uploaded image to JPEG bytes, memoized on its bytes.
+
+    Without this, re-clicking Analyze on the same uploads re-runs the
+    libjpeg/libpng decode and the JPEG re-encode on every rerun;
+    st.cache_data keys on the raw bytes so repeats are dict lookups.
+    """
+    import io
+    from PIL import Image
+
+    return prep_for_gemini(Image.open(io.BytesIO(raw)))
+
+# Request payloads (genai Parts) are expensive for st.cache_data to hash,
+# so they are registered here by content hash and only the hashes enter
+# cache keys.
+_IMAGE_REGISTRY = {}
+
+def register_image(jpeg_bytes):
+    """Register JPEG bytes as a genai Part; returns its content hash."""
+    key = hashlib.sha256(jpeg_bytes).hexdigest()
+    if key not in _IMAGE_REGISTRY:
+        _IMAGE_REGISTRY[key] = genai.types.Part.from_bytes(
+            data=jpeg_bytes, mime_type="image/jpeg"
+        )
+    return key
+
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def cached_generate(_client, model_id, prompt, image_hashes, cached_content=None):
+    """generate_content memoized on (prompt, image content) for an hour.
+
+    A repeated Analyze click on unchanged inputs becomes a dict lookup
+    instead of a multi-second, token-billed round trip. cached_content,
+    when set, names a server-side Gemini context cache for the static
+    prompt prefix.
+    """
+    parts = [_IMAGE_REGISTRY[h] for h in image_hashes]
+    config = _tier_config("label", cached_content)
+    response = _client.models.generate_content(
+        model=model_id,
+        contents=[prompt] + parts,
+        config=config
+    )
+    return response.text
+
+def _product_phash(jpeg_bytes):
+    """64-bit perceptual hash of a product photo.
+
+    Unlike the exact-bytes cache key, a perceptual hash is stable across
+    small angle/lighting changes, so re-photographing the same product
+    can still hit a previous analysis. Returns None when imagehash is
+    unavailable; computation is ~1 ms (DCT over a 32x32 grayscale).
+    """
+    try:
+        import imagehash
+    except ImportError:
+        return None
+    import io
+    from PIL import Image
+
+    return int(str(imagehash.phash(Image.open(io.BytesIO(jpeg_bytes)))), 16)
+
+def _find_similar_scan(phash_cache, new_hash, prompt, max_distance=6):
+    """Return a cached analysis for a near-duplicate product photo.
+
+    A Hamming distance of <= 6 over the 64-bit phash (~90% similarity)
+    is treated as the same product; the prompt must match exactly so a
+    changed health profile or focus selection never reuses stale text.
+    """
+    for known, (known_prompt, text) in phash_cache.items():
+        if known_prompt == prompt and bin(known ^ new_hash).count("1") <= max_distance:
+            return text
+    return None
+
+# Memoized cache names must expire before the 3600s server-side TTL:
+# once Gemini drops the cache, every call passing the stale name fails
+# until the name is recreated, so refresh 10 minutes early.
+@st.cache_resource(show_spinner=False, ttl=3000)
+def get_prompt_cache(_client, model_id, task, preamble):
+    """Register a static prompt preamble with Gemini explicit caching.
+
+    Cached prefix tokens are billed at ~10% and skip prefill on every
+    call. Returns the server-side cache name, or None when the API or
+    model doesn't support explicit caching - callers then inline the
+    preamble into the prompt as before.
+    """
+    try:
+        cache = _client.caches.create(
+            model=model_id,
+            config={"contents": [preamble], "ttl": "3600s", "display_name": task}
+        )
+        return cache.name
+    except Exception:
+        return None
+
+def _decode_barcode_local(jpeg_bytes):
+    """Try to read a barcode with pyzbar before spending an API call.
+
+    A local scan is a few milliseconds versus seconds for a model round
+    trip, and most product photos with a visible barcode decode fine.
+    Returns None when pyzbar (or its libzbar system library) is missing
+    or nothing decodes.
+    """
+    try:
+        from pyzbar.pyzbar import decode
+    except Exception:
+        return None
+    import io
+    from PIL import Image
+
+    gray = Image.open(io.BytesIO(jpeg_bytes)).convert("L")
+    if gray.width > 640:
+        ratio = 640 / gray.width
+        gray = gray.resize((640, int(gray.height * ratio)), Image.BILINEAR)
+    for symbol in decode(gray):
+        data = symbol.data.decode("utf-8", errors="ignore").strip()
+        if data:
+            return data
+    return None
+
+BARCODE_PROMPT = """Look at this image carefully. If there is a barcode or QR code visible:
 1. Try to read the numeric/alphanumeric code
 2. Return ONLY the code number/text, nothing else
 3. If no barcode is visible or readable, return "NONE"
 
 Return format: Just the barcode number or "NONE" """
-        
+
+def _parse_barcode_text(text):
+    """Normalize the model's barcode reply; None when nothing readable."""
+    result = text.strip()
+    if result.upper() == "NONE" or len(result) > 50:
+        return None
+    return result
+
+def get_barcode_via_ai(client, model_id, jpeg_bytes):
+    """Read a barcode locally via pyzbar, falling back to Gemini."""
+    local = _decode_barcode_local(jpeg_bytes)
+    if local is not None:
+        return local
+    try:
         response = client.models.generate_content(
             model=model_id,
-            contents=[prompt, image]
+            contents=[BARCODE_PROMPT, genai.types.Part.from_bytes(data=jpeg_bytes, mime_type="image/jpeg")],
+            config=_tier_config("label")
         )
-        
-        result = response.text.strip()
-        if result.upper() == "NONE" or len(result) > 50:
-            return None
-        return result
+        return _parse_barcode_text(response.text)
     except Exception:
         return None
 
 # --------------------------------------------------
 # LOGIN LOGIC
 # --------------------------------------------------
-users = load_users()
+user_con = user_db()
 
 if 'username' not in st.session_state:
     st.markdown('<h1 class="main-header">🧬 Smart Health & Kitchen</h1>', unsafe_allow_html=True)
@@ -162,7 +740,7 @@ if 'username' not in st.session_state:
             if st.button("🚀 Login", type="primary", use_container_width=True):
                 if not username or not password:
                     st.error("Please enter both username and password.")
-                elif username in users and users[username] == password:
+                elif verify_user(user_con, username, password):
                     st.session_state.username = username
                     st.rerun()
                 else:
@@ -172,13 +750,12 @@ if 'username' not in st.session_state:
             if st.button("📝 Sign Up", use_container_width=True):
                 if not username or not password:
                     st.warning("⚠️ Please enter username and password.")
-                elif username in users:
+                elif user_exists(user_con, username):
                     st.warning("⚠️ Username already exists. Please choose another.")
                 elif len(password) < 4:
                     st.warning("⚠️ Password must be at least 4 characters.")
                 else:
-                    users[username] = password
-                    save_users(users)
+                    add_user(user_con, username, password)
                     st.success("✅ Account created successfully! Please login.")
         
         st.markdown("---")
@@ -196,28 +773,187 @@ if 'username' not in st.session_state:
 # --------------------------------------------------
 # GEMINI INITIALIZATION
 # --------------------------------------------------
-try:
-    API_KEY = st.secrets["GEMINI_API_KEY"]
-except KeyError:
+@st.cache_resource
+def get_client():
+    """Create the Gemini client once per process.
+
+    Streamlit reruns the whole script on every widget click; caching the
+    client keeps its HTTP connection pool (and auth) alive across reruns
+    instead of re-initializing it each time.
+    """
+    return genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
+
+if "GEMINI_API_KEY" not in st.secrets:
     st.error("❌ GEMINI_API_KEY not found in secrets. Please add it to your Streamlit secrets.")
     st.stop()
 
-client = genai.Client(api_key=API_KEY)
-MODEL_ID = "gemini-3-flash-preview" 
+client = get_client()
+MODEL_ID = "gemini-3-flash-preview"
+
+# Text-only report extraction doesn't need the multimodal model;
+# Flash-Lite is cheaper and faster for structured extraction over a few
+# KB of text.
+TEXT_MODEL_ID = "gemini-flash-lite-latest"
+
+# Latency class per flow. The product scan has a user actively pointing
+# a camera at a shelf, so it rides the priority tier; report extraction
+# and fridge analysis tolerate queueing at flex (~half) pricing.
+SERVICE_TIERS = {"medical": "flex", "recipe": "flex", "label": "priority"}
+
+def _tier_config(task, cached_content=None, **kwargs):
+    """GenerateContentConfig carrying the flow's service tier."""
+    return genai.types.GenerateContentConfig(
+        service_tier=SERVICE_TIERS.get(task),
+        cached_content=cached_content,
+        **kwargs,
+    )
+
+class ClinicalReport(BaseModel):
+    """Response schema for the structured medical-report extraction.
+
+    Passed as response_schema so Gemini's JSON mode constrains decoding
+    to this shape; the markdown-fence stripping in clean_json_response
+    becomes a fallback instead of the happy path.
+    """
+    conditions: list[str] = []
+    lab_markers: dict[str, str] = {}
+    medications: list[str] = []
+    summary: str = ""
+
+# --------------------------------------------------
+# STATIC PROMPT PREAMBLES
+# --------------------------------------------------
+# The instruction bodies below never change between calls, so they are
+# registered with Gemini's explicit context caching (see get_prompt_cache)
+# and only the small per-user context block is sent as fresh tokens.
+RECIPE_PREAMBLE = """You are a professional nutritionist and chef. Analyze these kitchen/fridge images and provide comprehensive, personalized recommendations.
+
+## YOUR TASK:
+Analyze the images and provide:
+
+### 1. 🥬 DETECTED INGREDIENTS
+List ALL visible ingredients you can identify in the images. Be specific (e.g., "red bell pepper" not just "vegetables").
+
+### 2. 🔍 NUTRITIONAL GAP ANALYSIS
+Based on the user's health profile, analyze:
+- What nutrients might the user be lacking based on visible ingredients?
+- What specific deficiencies should be addressed?
+- How do visible ingredients align with their health needs?
+
+### 3. 🛒 SMART SHOPPING LIST
+Suggest 5-7 specific items the user should buy to:
+- Fill identified nutritional gaps
+- Address their health conditions
+- Complete the recipes you'll suggest
+Mark each as: 🔴 Essential | 🟡 Recommended | 🟢 Optional
+
+### 4. 👨‍🍳 PERSONALIZED RECIPES (3 recipes)
+For each recipe provide:
+
+**Recipe Name** (with emoji)
+- ⏱️ Prep/Cook Time
+- 📊 Difficulty: Easy/Medium/Hard
+- 🥗 Ingredients:
+  - ✅ Available (from fridge)
+  - 🛒 Need to buy
+- 📝 Quick Instructions (numbered steps)
+- 💪 Health Benefits (specific to user's conditions)
+- ⚠️ Allergen/Dietary Notes
+
+Make recipes practical, delicious, and aligned with their health goals!"""
+
+LABEL_PREAMBLE = """You are a food safety and nutrition expert. Analyze this food product image with extreme thoroughness.
+
+## PROVIDE A COMPREHENSIVE ANALYSIS:
+
+### 1. 🏷️ PRODUCT IDENTIFICATION
+- Product name and brand (if visible)
+- Category (snack, beverage, cereal, etc.)
+- Serving size and servings per container
+
+### 2. 📊 NUTRITIONAL BREAKDOWN
+List key nutritional values per serving:
+- Calories
+- Total Fat / Saturated Fat / Trans Fat
+- Sodium
+- Total Carbs / Sugars / Added Sugars
+- Protein
+- Key vitamins/minerals
+
+### 3. ⚠️ HIDDEN INGREDIENT WARNINGS
+Scan for and flag these RED FLAGS:
+- **Hidden Sugars**: maltodextrin, dextrose, corn syrup, fruit juice concentrate, etc.
+- **Excessive Sodium**: flag if >20% daily value per serving
+- **Harmful Additives**: MSG, nitrates/nitrites, artificial colors (Red 40, Yellow 5, etc.), BHA/BHT
+- **Artificial Sweeteners**: aspartame, sucralose, saccharin
+- **Preservatives**: sodium benzoate, potassium sorbate, TBHQ
+- **Trans Fats**: partially hydrogenated oils
+
+For each found, explain WHY it's concerning.
+
+### 4. 🏥 HEALTH PROFILE CONFLICTS
+Based on the user's health conditions in the context, specifically warn about any ingredients that could:
+- Worsen existing conditions
+- Interact with medications
+- Exceed recommended limits
+
+Use ⚠️ WARNING or 🚨 DANGER labels for serious conflicts.
+
+### 5. 📈 OVERALL HEALTH SCORE
+Rate this product:
+⭐ (Avoid) to ⭐⭐⭐⭐⭐ (Excellent Choice)
+
+Provide a brief explanation of the rating.
+
+### 6. ✅ HEALTHIER ALTERNATIVES
+Suggest 3-5 SPECIFIC alternative products that are:
+- Available in most grocery stores
+- Lower in problematic ingredients
+- Better suited to user's health profile
+- Similar in taste/function
+
+Format: **Product Name** - Why it's better
+
+### 7. 💡 SMART TIPS
+Quick tips for the user about this product category."""
+
+# Dynamic context shells for the two preambles above. The skeletons are
+# built once at import; each Analyze click only formats the handful of
+# user-specific values into them instead of re-assembling the whole
+# block literal.
+# Map stage of the multi-image fridge flow: each photo is described
+# independently with this short prompt, then one text-only fusion call
+# produces the final recommendations from the merged ingredient lists.
+INGREDIENT_DETECT_PROMPT = """List every food ingredient visible in this image, one per line.
+Be specific (e.g., "red bell pepper" not just "vegetables"). Output only
+the list — no headings, no commentary. If nothing edible is visible,
+return "NONE"."""
+
+RECIPE_CONTEXT_TMPL = """## USER CONTEXT:
+- **Health Profile**: {health_ctx}
+- **Dietary Restrictions**: {dietary}
+- **Preferred Cuisines**: {cuisine}
+- **Meal Type**: {meal}
+- **Available Cooking Time**: {cooking_time}"""
+
+LABEL_CONTEXT_TMPL = """## CONTEXT:
+- **Barcode/Product ID**: {barcode}
+- **User Health Profile**: {health}
+- **Analysis Focus Areas**: {focus}"""
 
 # --------------------------------------------------
 # SESSION STATE INITIALIZATION
 # --------------------------------------------------
-session_keys = {
-    "clinical_data": None,
-    "clinical_history": [],
-    "recipe_history": [],
-    "product_scan_history": []
-}
+# Histories are bounded deques: appends past HISTORY_MAXLEN silently
+# drop the oldest entry instead of growing the session without limit.
+# On a fresh session they rehydrate from the on-disk store, so past
+# analyses survive reconnects without re-running anything.
+if "clinical_data" not in st.session_state:
+    st.session_state.clinical_data = None
 
-for key, default in session_keys.items():
-    if key not in st.session_state:
-        st.session_state[key] = default
+for kind in ("clinical", "recipe", "product_scan"):
+    if f"{kind}_history" not in st.session_state:
+        st.session_state[f"{kind}_history"] = load_history(kind)
 
 # --------------------------------------------------
 # SIDEBAR
@@ -225,10 +961,7 @@ for key, default in session_keys.items():
 with st.sidebar:
     st.markdown(f"## 👤 Welcome, **{st.session_state.username}**!")
     
-    if st.button("🚪 Logout", use_container_width=True):
-        for key in list(st.session_state.keys()):
-            del st.session_state[key]
-        st.rerun()
+    st.button("🚪 Logout", use_container_width=True, on_click=_logout)
     
     st.markdown("---")
     
@@ -254,9 +987,7 @@ with st.sidebar:
             for marker, value in list(markers.items())[:3]:
                 st.markdown(f"• {marker}: {value}")
         
-        if st.button("🗑️ Clear Profile", use_container_width=True):
-            st.session_state.clinical_data = None
-            st.rerun()
+        st.button("🗑️ Clear Profile", use_container_width=True, on_click=_clear_profile)
     else:
         st.warning("⚠️ No Profile Loaded")
         st.caption("Upload a medical report to get personalized recommendations.")
@@ -294,7 +1025,9 @@ tab1, tab2, tab3, tab4 = st.tabs([
 # ==================================================
 # TAB 1: MEDICAL ANALYZER
 # ==================================================
-with tab1:
+@st.fragment
+def render_medical():
+    """Medical analyzer tab body; reruns independently of other tabs."""
     st.markdown('<div class="tab-content">', unsafe_allow_html=True)
     st.markdown("## 🏥 Medical Report Analysis")
     st.markdown("Upload your lab reports to extract health markers and build your personalized medical profile.")
@@ -324,8 +1057,19 @@ with tab1:
             if uploaded_file.type == "text/plain":
                 content = uploaded_file.read().decode("utf-8")
             else:
-                reader = PdfReader(uploaded_file)
-                content = "\n".join(page.extract_text() or "" for page in reader.pages)
+                raw_pdf = uploaded_file.getvalue()
+                n_pages = pdf_page_count(raw_pdf)
+                if n_pages > MAX_EAGER_PAGES:
+                    # Don't eagerly parse huge documents; let the user
+                    # sample a page range instead of risking an OOM.
+                    st.warning(f"⚠️ This PDF has {n_pages} pages - select a range to analyze.")
+                    page_start, page_end = st.slider(
+                        "Pages to analyze", 1, n_pages, (1, 50),
+                        key="pdf_page_range"
+                    )
+                    content = extract_pdf_text(raw_pdf, (page_start - 1, page_end))
+                else:
+                    content = extract_pdf_text(raw_pdf)
             
             if not content.strip():
                 st.error("❌ Could not extract text from the file. Please ensure the PDF contains readable text.")
@@ -339,97 +1083,107 @@ with tab1:
                 
                 if st.button("🔍 Analyze & Extract Health Markers", type="primary", use_container_width=True):
                     with st.spinner("🧠 AI is analyzing your medical report..."):
-                        prompt = """You are a medical data extraction specialist. Analyze this medical report carefully and extract all relevant clinical information.
-
-Return the data in this EXACT JSON format (no additional text, just the JSON):
-{
-    "conditions": ["list of diagnosed conditions, diseases, or health issues mentioned"],
-    "lab_markers": {
-        "marker_name": "value with units"
-    },
-    "medications": ["list of any medications mentioned"],
-    "summary": "A brief 2-3 sentence summary of the patient's overall health status based on this report"
-}
-
-Important:
-- Extract ALL lab values with their units (e.g., "Glucose": "95 mg/dL")
-- Include reference ranges if mentioned
-- Be thorough - don't miss any markers
-- If a field has no data, use an empty list [] or empty object {}
-
-Analyze this report:"""
+                        # The response schema pins the output shape, so the
+                        # prompt only has to describe what to extract.
+                        prompt = """You are a medical data extraction specialist. Extract all clinical information from this report:
+- conditions: diagnosed conditions, diseases, or health issues
+- lab_markers: every lab value with its units (e.g. "Glucose": "95 mg/dL"), including reference ranges if mentioned
+- medications: any medications mentioned
+- summary: 2-3 sentences on the patient's overall health status
+
+Be thorough - don't miss any markers. Analyze this report:"""
 
                         try:
-                            response = client.models.generate_content(
-                                model=MODEL_ID, 
-                                contents=[prompt, content]
+                            content_hash = hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+                            extracted_data = analyze_report(
+                                client, TEXT_MODEL_ID, content_hash, prompt, content,
+                                _config=_tier_config(
+                                    "medical",
+                                    response_mime_type="application/json",
+                                    response_schema=ClinicalReport,
+                                )
                             )
-                            
-                            extracted_data = clean_json_response(response.text)
-                            
+
                             # Update session state
                             st.session_state.clinical_data = extracted_data
-                            st.session_state.clinical_history.append({
-                                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                            st.session_state.health_ctx_str = _health_context(extracted_data)
+                            new_entry = {
+                                "timestamp": datetime.now(timezone.utc).isoformat(timespec="minutes"),
                                 "filename": uploaded_file.name,
                                 "data": extracted_data
-                            })
-                            
-                            st.success("✅ Medical Profile Updated Successfully!")
-                            st.balloons()
-                            
-                            # Display results
-                            st.markdown("---")
-                            st.markdown("### 📊 Extracted Information")
-                            
-                            col1, col2 = st.columns(2)
-                            
-                            with col1:
-                                st.markdown("#### 🩺 Conditions")
-                                conditions = extracted_data.get("conditions", [])
-                                if conditions:
-                                    for cond in conditions:
-                                        st.markdown(f"• {cond}")
-                                else:
-                                    st.info("No specific conditions identified")
-                                
-                                st.markdown("#### 💊 Medications")
-                                medications = extracted_data.get("medications", [])
-                                if medications:
-                                    for med in medications:
-                                        st.markdown(f"• {med}")
-                                else:
-                                    st.info("No medications mentioned")
-                            
-                            with col2:
-                                st.markdown("#### 🔬 Lab Markers")
-                                markers = extracted_data.get("lab_markers", {})
-                                if markers:
-                                    for marker, value in markers.items():
-                                        st.markdown(f"**{marker}:** {value}")
-                                else:
-                                    st.info("No lab markers found")
-                            
-                            st.markdown("#### 📝 Summary")
-                            summary = extracted_data.get("summary", "No summary available.")
-                            st.info(summary)
-                            
+                            }
+                            append_history("clinical", new_entry)
+                            persist_markers(st.session_state.username, _flatten_markers([new_entry]))
+
+                            # Fragments rerun in isolation, so the sidebar
+                            # profile panel and the other tabs' health
+                            # banners would keep showing the pre-analysis
+                            # state; a full-app rerun refreshes them all.
+                            st.session_state.profile_updated = True
+                            st.rerun(scope="app")
+
                         except json.JSONDecodeError as e:
                             st.error(f"❌ Failed to parse AI response. Please try again.")
                             with st.expander("Debug Info"):
-                                st.text(response.text)
+                                st.text(str(e))
                         except Exception as e:
                             st.error(f"❌ Analysis failed: {str(e)}")
                             
         except Exception as e:
             st.error(f"❌ Error reading file: {str(e)}")
-    
+
+    if st.session_state.pop("profile_updated", False):
+        st.success("✅ Medical Profile Updated Successfully!")
+        st.balloons()
+
+    # Rendered from session state rather than the Analyze branch, so the
+    # extracted profile survives the full-app rerun and stays visible on
+    # later visits to the tab.
+    if st.session_state.clinical_data:
+        extracted_data = st.session_state.clinical_data
+        st.markdown("---")
+        st.markdown("### 📊 Extracted Information")
+
+        col1, col2 = st.columns(2)
+
+        with col1:
+            st.markdown("#### 🩺 Conditions")
+            conditions = extracted_data.get("conditions", [])
+            if conditions:
+                for cond in conditions:
+                    st.markdown(f"• {cond}")
+            else:
+                st.info("No specific conditions identified")
+
+            st.markdown("#### 💊 Medications")
+            medications = extracted_data.get("medications", [])
+            if medications:
+                for med in medications:
+                    st.markdown(f"• {med}")
+            else:
+                st.info("No medications mentioned")
+
+        with col2:
+            st.markdown("#### 🔬 Lab Markers")
+            markers = extracted_data.get("lab_markers", {})
+            if markers:
+                for marker, value in markers.items():
+                    st.markdown(f"**{marker}:** {value}")
+            else:
+                st.info("No lab markers found")
+
+        st.markdown("#### 📝 Summary")
+        summary = extracted_data.get("summary", "No summary available.")
+        st.info(summary)
+
     st.markdown('</div>', unsafe_allow_html=True)
 
 # ==================================================
 # TAB 2: FRIDGE SCANNER
 # ==================================================
-with tab2:
+@st.fragment
+def render_fridge():
+    """Fridge scanner tab body; reruns independently of other tabs."""
     st.markdown('<div class="tab-content">', unsafe_allow_html=True)
     st.markdown("## 🥗 Smart Kitchen & Micronutrient Gap Analysis")
     st.markdown("Scan your fridge or pantry to get personalized, health-conscious recipe suggestions.")
@@ -454,37 +1208,39 @@ with tab2:
             key="fridge_input_mode"
         )
         
-        fridge_images = []
-        
+        # Only raw bytes are kept per rerun; thumbnails use a cheap draft
+        # decode and the full decode happens when Analyze is pressed.
+        fridge_raws = []
+
         if input_mode == "📷 Use Camera":
             cam_img = st.camera_input("📷 Take a photo of your fridge/pantry")
             if cam_img:
-                fridge_images = [Image.open(cam_img)]
+                fridge_raws = [cam_img.getvalue()]
                 st.success("✅ Photo captured!")
         else:
             files = st.file_uploader(
-                "Upload photos of your fridge, pantry, or ingredients", 
+                "Upload photos of your fridge, pantry, or ingredients",
                 type=["jpg", "png", "jpeg"],
                 accept_multiple_files=True,
                 key="fridge_uploader",
                 help="You can upload multiple images"
             )
             if files:
-                fridge_images = [Image.open(f) for f in files]
+                fridge_raws = [f.getvalue() for f in files]
                 st.success(f"✅ {len(files)} image(s) uploaded!")
-                
+
                 # Show thumbnails
-                if len(fridge_images) <= 4:
-                    cols = st.columns(len(fridge_images))
-                    for i, img in enumerate(fridge_images):
+                if len(fridge_raws) <= 4:
+                    cols = st.columns(len(fridge_raws))
+                    for i, raw in enumerate(fridge_raws):
                         with cols[i]:
-                            st.image(img, use_container_width=True)
+                            st.image(decode_thumb(raw), use_container_width=True)
                 else:
                     cols = st.columns(4)
-                    for i, img in enumerate(fridge_images[:4]):
+                    for i, raw in enumerate(fridge_raws[:4]):
                         with cols[i]:
-                            st.image(img, use_container_width=True)
-                    st.caption(f"...and {len(fridge_images) - 4} more images")
+                            st.image(decode_thumb(raw), use_container_width=True)
+                    st.caption(f"...and {len(fridge_raws) - 4} more images")
     
     with col_pref:
         st.markdown("### 🍽️ Your Preferences")
@@ -516,88 +1272,146 @@ with tab2:
     
     st.markdown("---")
     
-    if fridge_images:
+    if fridge_raws:
         if st.button("🍽️ Analyze & Get Personalized Recipes", type="primary", use_container_width=True):
             with st.spinner("🧠 Analyzing ingredients and calculating nutritional gaps..."):
+                # Full-resolution decode + downscale only happens here, on
+                # the actual submit path (memoized on content bytes). The
+                # registry wraps each JPEG in a genai Part so the SDK sends
+                # the bytes verbatim instead of re-encoding a PIL image.
+                fridge_jpegs = [decode_image(raw) for raw in fridge_raws]
+                image_hashes = tuple(register_image(j) for j in fridge_jpegs)
+                fridge_parts = [_IMAGE_REGISTRY[h] for h in image_hashes]
                 # Prepare context
-                health_ctx = json.dumps(st.session_state.clinical_data or {"note": "No specific health conditions - use general healthy eating guidelines"})
+                health_ctx = (
+                    st.session_state.get("health_ctx_str")
+                    or _health_context(st.session_state.clinical_data)
+                    or jdumps({"note": "No specific health conditions - use general healthy eating guidelines"})
+                )
                 dietary_str = ", ".join(dietary) if dietary else "None specified"
                 cuisine_str = ", ".join(cuisine) if cuisine else "Any cuisine"
                 
-                prompt = f"""You are a professional nutritionist and chef. Analyze these kitchen/fridge images and provide comprehensive, personalized recommendations.
-
-## USER CONTEXT:
-- **Health Profile**: {health_ctx}
-- **Dietary Restrictions**: {dietary_str}
-- **Preferred Cuisines**: {cuisine_str}
-- **Meal Type**: {meal}
-- **Available Cooking Time**: {cooking_time}
-
-## YOUR TASK:
-Analyze the images and provide:
-
-### 1. 🥬 DETECTED INGREDIENTS
-List ALL visible ingredients you can identify in the images. Be specific (e.g., "red bell pepper" not just "vegetables").
+                user_ctx = RECIPE_CONTEXT_TMPL.format(
+                    health_ctx=health_ctx,
+                    dietary=dietary_str,
+                    cuisine=cuisine_str,
+                    meal=meal,
+                    cooking_time=cooking_time,
+                )
 
-### 2. 🔍 NUTRITIONAL GAP ANALYSIS
-Based on the user's health profile, analyze:
-- What nutrients might the user be lacking based on visible ingredients?
-- What specific deficiencies should be addressed?
-- How do visible ingredients align with their health needs?
+                # With a server-side context cache only the small dynamic
+                # block is sent as fresh tokens; otherwise inline the
+                # preamble as before.
+                cache_name = get_prompt_cache(client, MODEL_ID, "recipe", RECIPE_PREAMBLE)
+                if cache_name:
+                    prompt = user_ctx
+                    gen_config = _tier_config("recipe", cache_name)
+                else:
+                    prompt = RECIPE_PREAMBLE + "\n\n" + user_ctx
+                    gen_config = _tier_config("recipe")
 
-### 3. 🛒 SMART SHOPPING LIST
-Suggest 5-7 specific items the user should buy to:
-- Fill identified nutritional gaps
-- Address their health conditions
-- Complete the recipes you'll suggest
-Mark each as: 🔴 Essential | 🟡 Recommended | 🟢 Optional
+                try:
+                    st.markdown("---")
+                    st.markdown("## 🍳 Your Personalized Kitchen Analysis")
 
-### 4. 👨‍🍳 PERSONALIZED RECIPES (3 recipes)
-For each recipe provide:
+                    # The streaming path can't go through cached_generate, so
+                    # repeats are served from a session-level memo instead.
+                    recipe_key = hashlib.sha256(
+                        (prompt + "|".join(image_hashes)).encode()
+                    ).hexdigest()
+                    recipe_cache = st.session_state.setdefault("recipe_cache", {})
 
-**Recipe Name** (with emoji)
-- ⏱️ Prep/Cook Time
-- 📊 Difficulty: Easy/Medium/Hard
-- 🥗 Ingredients:
-  - ✅ Available (from fridge)
-  - 🛒 Need to buy
-- 📝 Quick Instructions (numbered steps)
-- 💪 Health Benefits (specific to user's conditions)
-- ⚠️ Allergen/Dietary Notes
+                    if recipe_key in recipe_cache:
+                        analysis_text = recipe_cache[recipe_key]
+                        st.markdown(analysis_text)
+                    elif len(fridge_parts) >= MAP_REDUCE_MIN_IMAGES:
+                        # Map-reduce over independent photos: stuffing many
+                        # images into one call means a huge prefill and an
+                        # answer that has to reason about all of them at
+                        # once. Instead each image gets a cheap concurrent
+                        # ingredient-detection call, and a single text-only
+                        # fusion call writes the actual recommendations —
+                        # which can still stream to the user.
+                        detections = generate_parallel(
+                            client, MODEL_ID,
+                            [[INGREDIENT_DETECT_PROMPT, p] for p in fridge_parts],
+                            config=_tier_config("recipe"),
+                        )
+                        ingredient_lists = [
+                            r.text.strip() for r in detections
+                            if r.text and r.text.strip() != "NONE"
+                        ]
+                        fused_prompt = (
+                            prompt
+                            + "\n\n## INGREDIENTS DETECTED IN THE USER'S PHOTOS:\n"
+                            + "\n".join(ingredient_lists)
+                        )
+                        stream = client.models.generate_content_stream(
+                            model=MODEL_ID,
+                            contents=[fused_prompt],
+                            config=gen_config
+                        )
+                        analysis_text = st.write_stream(
+                            chunk.text for chunk in stream if chunk.text
+                        )
+                    else:
+                        # Stream tokens as they arrive instead of blocking on
+                        # the full completion; first output shows in ~a second.
+                        stream = client.models.generate_content_stream(
+                            model=MODEL_ID,
+                            contents=[prompt] + fridge_parts,
+                            config=gen_config
+                        )
+                        analysis_text = st.write_stream(
+                            chunk.text for chunk in stream if chunk.text
+                        )
 
-Make recipes practical, delicious, and aligned with their health goals!"""
+                    recipe_cache[recipe_key] = analysis_text
 
-                try:
-                    response = client.models.generate_content(
-                        model=MODEL_ID, 
-                        contents=[prompt] + fridge_images
-                    )
-                    
-                    st.markdown("---")
-                    st.markdown("## 🍳 Your Personalized Kitchen Analysis")
-                    st.markdown(response.text)
-                    
                     # Save to history
-                    st.session_state.recipe_history.append({
-                        "timestamp": datetime.now().isoformat(),
+                    append_history("recipe", {
+                        "timestamp": datetime.now(timezone.utc).isoformat(timespec="minutes"),
                         "meal": meal,
                         "cuisines": cuisine,
-                        "content": response.text
+                        "content": analysis_text
                     })
-                    
-                    st.success("✅ Analysis saved to your history!")
-                    
+
+                    # History changed: rerun the whole app so tab4 and the
+                    # sidebar pick it up (fragment reruns stay local). The
+                    # result is stored with the key of the images that
+                    # produced it so it never renders under different ones.
+                    fridge_key = tuple(hashlib.sha1(r).hexdigest() for r in fridge_raws)
+                    st.session_state.last_recipe = (fridge_key, analysis_text)
+                    st.rerun(scope="app")
+
                 except Exception as e:
                     st.error(f"❌ Analysis failed: {str(e)}")
     else:
         st.info("👆 Please upload photos or take a picture of your fridge/pantry to get started.")
-    
+
+    # Re-rendered from session state after the full-app rerun above, so
+    # the analysis stays on screen once the Analyze branch has finished —
+    # but only while the images it was generated from are still attached;
+    # a different upload must not sit under the previous answer.
+    last_recipe = st.session_state.get("last_recipe")
+    if (
+        fridge_raws
+        and last_recipe
+        and last_recipe[0] == tuple(hashlib.sha1(r).hexdigest() for r in fridge_raws)
+    ):
+        st.markdown("---")
+        st.markdown("## 🍳 Your Personalized Kitchen Analysis")
+        st.markdown(last_recipe[1])
+        st.success("✅ Analysis saved to your history!")
+
     st.markdown('</div>', unsafe_allow_html=True)
 
 # ==================================================
 # TAB 3: BARCODE & LABEL SCANNER
 # ==================================================
-with tab3:
+@st.fragment
+def render_product():
+    """Label scanner tab body; reruns independently of other tabs."""
     st.markdown('<div class="tab-content">', unsafe_allow_html=True)
     st.markdown("## 🔍 Product Label Deep Dive")
     st.markdown("Scan any food product to uncover hidden ingredients, check health compatibility, and find better alternatives.")
@@ -622,12 +1436,12 @@ with tab3:
             key="product_scan_mode"
         )
         
-        product_image = None
+        product_jpeg = None
         
         if scan_mode == "📷 Use Camera":
             cam_shot = st.camera_input("📷 Point camera at product label or barcode")
             if cam_shot:
-                product_image = Image.open(cam_shot)
+                product_jpeg = decode_image(cam_shot.getvalue())
         else:
             uploaded_product = st.file_uploader(
                 "Upload product label, nutrition facts, or barcode image",
@@ -636,15 +1450,21 @@ with tab3:
                 help="For best results, capture the nutrition facts label clearly"
             )
             if uploaded_product:
-                product_image = Image.open(uploaded_product)
-        
-        if product_image:
-            st.image(product_image, caption="Product Image", use_container_width=True)
+                product_jpeg = decode_image(uploaded_product.getvalue())
+
+        if product_jpeg:
+            st.image(product_jpeg, caption="Product Image", use_container_width=True)
             
-            # Try to read barcode using AI
+            # Try to read the barcode exactly once per distinct image; the
+            # result is memoized in session state so the Analyze handler
+            # (and every rerun) reuses it instead of re-calling Gemini.
             with st.spinner("🔍 Checking for barcode..."):
-                barcode_id = get_barcode_via_ai(client, MODEL_ID, product_image)
-                
+                barcode_cache = st.session_state.setdefault("barcode_cache", {})
+                product_key = hashlib.sha1(product_jpeg).hexdigest()
+                if product_key not in barcode_cache:
+                    barcode_cache[product_key] = get_barcode_via_ai(client, MODEL_ID, product_jpeg)
+                barcode_id = barcode_cache[product_key]
+
                 if barcode_id:
                     st.success(f"✅ Barcode Detected: `{barcode_id}`")
                 else:
@@ -661,92 +1481,80 @@ with tab3:
     with col_results:
         st.markdown("### 📋 Analysis Results")
         
-        if product_image:
+        if product_jpeg:
             if st.button("🔬 Analyze Product", type="primary", use_container_width=True):
                 with st.spinner("🧠 Performing deep analysis of product ingredients..."):
-                    barcode_id = get_barcode_via_ai(client, MODEL_ID, product_image)
-                    medical_context = st.session_state.clinical_data or {}
+                    # The render path above already resolved the barcode
+                    # for this image (pyzbar first, Gemini fallback) and
+                    # cached the result, so the handler only reads it.
+                    barcode_cache = st.session_state.setdefault("barcode_cache", {})
+                    product_key = hashlib.sha1(product_jpeg).hexdigest()
+                    barcode_id = barcode_cache.get(product_key)
+                    health_ctx = (
+                        st.session_state.get("health_ctx_str")
+                        or _health_context(st.session_state.clinical_data)
+                    )
                     focus_areas = ", ".join(analysis_focus) if analysis_focus else "All potential concerns"
-                    
-                    prompt = f"""You are a food safety and nutrition expert. Analyze this food product image with extreme thoroughness.
-
-## CONTEXT:
-- **Barcode/Product ID**: {barcode_id if barcode_id else "Not detected - analyze using visible label information"}
-- **User Health Profile**: {json.dumps(medical_context) if medical_context else "No specific health conditions provided"}
-- **Analysis Focus Areas**: {focus_areas}
-
-## PROVIDE A COMPREHENSIVE ANALYSIS:
 
-### 1. 🏷️ PRODUCT IDENTIFICATION
-- Product name and brand (if visible)
-- Category (snack, beverage, cereal, etc.)
-- Serving size and servings per container
-
-### 2. 📊 NUTRITIONAL BREAKDOWN
-List key nutritional values per serving:
-- Calories
-- Total Fat / Saturated Fat / Trans Fat
-- Sodium
-- Total Carbs / Sugars / Added Sugars
-- Protein
-- Key vitamins/minerals
-
-### 3. ⚠️ HIDDEN INGREDIENT WARNINGS
-Scan for and flag these RED FLAGS:
-- **Hidden Sugars**: maltodextrin, dextrose, corn syrup, fruit juice concentrate, etc.
-- **Excessive Sodium**: flag if >20% daily value per serving
-- **Harmful Additives**: MSG, nitrates/nitrites, artificial colors (Red 40, Yellow 5, etc.), BHA/BHT
-- **Artificial Sweeteners**: aspartame, sucralose, saccharin
-- **Preservatives**: sodium benzoate, potassium sorbate, TBHQ
-- **Trans Fats**: partially hydrogenated oils
-
-For each found, explain WHY it's concerning.
-
-### 4. 🏥 HEALTH PROFILE CONFLICTS
-{"Based on the user's health conditions (" + str(list(medical_context.get('conditions', []))) + "), specifically warn about any ingredients that could:" if medical_context else "General health warnings:"}
-- Worsen existing conditions
-- Interact with medications
-- Exceed recommended limits
-
-Use ⚠️ WARNING or 🚨 DANGER labels for serious conflicts.
-
-### 5. 📈 OVERALL HEALTH SCORE
-Rate this product: 
-⭐ (Avoid) to ⭐⭐⭐⭐⭐ (Excellent Choice)
+                    context_block = LABEL_CONTEXT_TMPL.format(
+                        barcode=barcode_id if barcode_id else "Not detected - analyze using visible label information",
+                        health=health_ctx or "No specific health conditions provided",
+                        focus=focus_areas,
+                    )
 
-Provide a brief explanation of the rating.
+                    cache_name = get_prompt_cache(client, MODEL_ID, "label", LABEL_PREAMBLE)
+                    if cache_name:
+                        prompt = context_block
+                    else:
+                        prompt = LABEL_PREAMBLE + "\n\n" + context_block
 
-### 6. ✅ HEALTHIER ALTERNATIVES
-Suggest 3-5 SPECIFIC alternative products that are:
-- Available in most grocery stores
-- Lower in problematic ingredients
-- Better suited to user's health profile
-- Similar in taste/function
+                    # Near-duplicate check: a re-upload of the same product
+                    # shot from a slightly different angle won't match the
+                    # exact-bytes cache but will match on perceptual hash.
+                    phash_cache = st.session_state.setdefault("scan_phash_cache", {})
+                    new_phash = _product_phash(product_jpeg)
+                    similar_text = (
+                        _find_similar_scan(phash_cache, new_phash, prompt)
+                        if new_phash is not None else None
+                    )
 
-Format: **Product Name** - Why it's better
+                    try:
+                        if similar_text is not None:
+                            analysis_text = similar_text
+                        else:
+                            analysis_text = cached_generate(
+                                client, MODEL_ID, prompt,
+                                (register_image(product_jpeg),),
+                                cached_content=cache_name
+                            )
 
-### 7. 💡 SMART TIPS
-Quick tips for the user about this product category."""
+                        if new_phash is not None:
+                            phash_cache[new_phash] = (prompt, analysis_text)
 
-                    try:
-                        response = client.models.generate_content(
-                            model=MODEL_ID,
-                            contents=[prompt, product_image]
-                        )
-                        
-                        st.markdown(response.text)
-                        
                         # Save to history
-                        st.session_state.product_scan_history.append({
-                            "timestamp": datetime.now().isoformat(),
+                        append_history("product_scan", {
+                            "timestamp": datetime.now(timezone.utc).isoformat(timespec="minutes"),
                             "barcode": barcode_id,
-                            "analysis": response.text
+                            "analysis": analysis_text
                         })
-                        
-                        st.success("✅ Analysis saved to your history!")
-                        
+
+                        # History changed: rerun the whole app so tab4 and
+                        # the sidebar pick it up (fragment reruns stay
+                        # local); the result re-renders from session state
+                        # below, keyed to the image it came from.
+                        st.session_state.last_scan = (product_key, analysis_text)
+                        st.rerun(scope="app")
+
                     except Exception as e:
                         st.error(f"❌ Analysis failed: {str(e)}")
+
+            # Only show the stored analysis while the image it was
+            # generated from is still the one attached: a newly uploaded
+            # product must not appear under the previous one's verdict.
+            last_scan = st.session_state.get("last_scan")
+            if last_scan and last_scan[0] == hashlib.sha1(product_jpeg).hexdigest():
+                st.markdown(last_scan[1])
+                st.success("✅ Analysis saved to your history!")
         else:
             st.info("👈 Upload or capture a product image to begin analysis")
             
@@ -763,146 +1571,158 @@ Quick tips for the user about this product category."""
 # ==================================================
 # TAB 4: HISTORY & TRENDS
 # ==================================================
-with tab4:
-    st.markdown('<div class="tab-content">', unsafe_allow_html=True)
-    st.markdown("## 📈 Health Tracking & History")
-    st.markdown("Track your lab values over time and review your past analyses.")
-    
-    # --------------------------------------------------
-    # LAB MARKER TRENDS
-    # --------------------------------------------------
+@st.fragment
+def _render_lab_trends():
+    """Lab-trends section, isolated as a fragment.
+
+    Changing the marker selectbox reruns only this function instead of
+    the whole script, so tab1-tab3 widget construction and the Gemini
+    cache lookups are skipped on every chart interaction.
+    """
     st.markdown("### 📊 Lab Marker Trends")
-    
-    if st.session_state.clinical_history:
-        # Prepare data for charting
-        all_markers = []
-        for entry in st.session_state.clinical_history:
-            date = entry["timestamp"]
-            markers = entry["data"].get("lab_markers", {})
-            for m_name, m_val in markers.items():
-                num_val = extract_numeric(m_val)
-                if num_val is not None:
-                    all_markers.append({
-                        "Date": date, 
-                        "Marker": m_name.lower().strip(), 
-                        "Value": num_val
-                    })
+
+    import pandas as pd
+
+    # Combine markers from this session with the on-disk store so trends
+    # survive process restarts; the persisted store is the superset.
+    session_df = build_marker_frame(list(st.session_state.clinical_history))
+    stored_df = load_marker_store(st.session_state.username)
+    df = pd.concat([stored_df, session_df], ignore_index=True)
+    df = df.drop_duplicates(subset=["Date", "Marker", "Value"])
+    idx = marker_index(df)
+
+    if idx:
+        unique_markers = sorted(idx)
         
-        if all_markers:
-            df = pd.DataFrame(all_markers)
-            unique_markers = sorted(df["Marker"].unique())
-            
-            col_select, col_info = st.columns([2, 1])
-            
-            with col_select:
-                selected_marker = st.selectbox(
-                    "Select a lab marker to visualize:", 
-                    unique_markers,
-                    key="trend_marker_select"
-                )
-            
-            with col_info:
-                marker_count = len(df[df["Marker"] == selected_marker])
-                st.metric("Data Points", marker_count)
-            
-            plot_df = df[df["Marker"] == selected_marker].sort_values("Date")
-            
-            col_chart, col_stats = st.columns([2, 1])
-            
-            with col_chart:
-                st.subheader(f"📈 {selected_marker.title()} Over Time")
-                st.line_chart(data=plot_df, x="Date", y="Value", height=350)
+        col_select, col_info = st.columns([2, 1])
+        
+        with col_select:
+            selected_marker = st.selectbox(
+                "Select a lab marker to visualize:", 
+                unique_markers,
+                key="trend_marker_select"
+            )
+        
+        with col_info:
+            marker_count = len(idx[selected_marker])
+            st.metric("Data Points", marker_count)
+
+        plot_df = idx[selected_marker]
+        
+        col_chart, col_stats = st.columns([2, 1])
+        
+        with col_chart:
+            st.subheader(f"📈 {selected_marker.title()} Over Time")
+            # Statistics below still use the full series; only the chart
+            # payload is reduced.
+            chart_df = _lttb_downsample(plot_df) if len(plot_df) >= 300 else plot_df
+            st.line_chart(data=chart_df, x="Date", y="Value", height=350)
+        
+        with col_stats:
+            st.subheader("📊 Statistics")
             
-            with col_stats:
-                st.subheader("📊 Statistics")
-                
-                if len(plot_df) >= 1:
-                    current_val = plot_df["Value"].iloc[-1]
-                    st.metric(label="Latest Value", value=f"{current_val:.2f}")
+            # Scalar reads off the NumPy buffer skip pandas' iloc machinery.
+            vals = plot_df["Value"].to_numpy()
+
+            if len(vals) >= 1:
+                current_val = vals[-1]
+                st.metric(label="Latest Value", value=f"{current_val:.2f}")
+
+                if len(vals) > 1:
+                    first_val = vals[0]
+                    diff = current_val - first_val
+                    percent = (diff / first_val) * 100 if first_val != 0 else 0
                     
-                    if len(plot_df) > 1:
-                        first_val = plot_df["Value"].iloc[0]
-                        diff = current_val - first_val
-                        percent = (diff / first_val) * 100 if first_val != 0 else 0
-                        
-                        st.metric(
-                            label="First Value",
-                            value=f"{first_val:.2f}"
-                        )
-                        
-                        delta_color = "normal"
-                        st.metric(
-                            label="Total Change",
-                            value=f"{abs(diff):.2f}",
-                            delta=f"{percent:+.1f}%"
-                        )
-                        
-                        st.metric(label="Readings", value=len(plot_df))
-                        
-                        # Trend indicator
-                        if percent > 5:
-                            st.warning("📈 Trending UP")
-                        elif percent < -5:
-                            st.info("📉 Trending DOWN")
-                        else:
-                            st.success("➡️ Stable")
+                    st.metric(
+                        label="First Value",
+                        value=f"{first_val:.2f}"
+                    )
+                    
+                    delta_color = "normal"
+                    st.metric(
+                        label="Total Change",
+                        value=f"{abs(diff):.2f}",
+                        delta=f"{percent:+.1f}%"
+                    )
+                    
+                    st.metric(label="Readings", value=len(plot_df))
+                    
+                    # Trend indicator
+                    if percent > 5:
+                        st.warning("📈 Trending UP")
+                    elif percent < -5:
+                        st.info("📉 Trending DOWN")
                     else:
-                        st.info("Upload more reports to see trends")
-        else:
-            st.info("No numeric lab markers found in your reports. Upload a report with lab values to see trends.")
+                        st.success("➡️ Stable")
+                else:
+                    st.info("Upload more reports to see trends")
+    elif st.session_state.clinical_history:
+        st.info("No numeric lab markers found in your reports. Upload a report with lab values to see trends.")
     else:
         st.info("📄 Upload medical reports in the 'Medical Analyzer' tab to track your health over time.")
-    
+
+@st.fragment
+def render_history():
+    """History & trends tab body; reruns independently of other tabs."""
+    st.markdown('<div class="tab-content">', unsafe_allow_html=True)
+    st.markdown("## 📈 Health Tracking & History")
+    st.markdown("Track your lab values over time and review your past analyses.")
+
+    # --------------------------------------------------
+    # LAB MARKER TRENDS
+    # --------------------------------------------------
+    _render_lab_trends()
+
     st.markdown("---")
     
     # --------------------------------------------------
     # HISTORY SECTIONS
     # --------------------------------------------------
     st.markdown("### 📚 Complete History")
-    
+
+    # Entry bodies render only while their toggle is on. A collapsed
+    # st.expander still sends its full markdown/JSON body to the browser
+    # on every rerun; with 50-entry histories that is hundreds of KB per
+    # widget interaction for content nobody is looking at.
     col_h1, col_h2, col_h3 = st.columns(3)
-    
+
     with col_h1:
         st.markdown("#### 📄 Medical Reports")
         if st.session_state.clinical_history:
-            for i, record in enumerate(reversed(st.session_state.clinical_history)):
-                with st.expander(f"📋 {record['timestamp']} - {record.get('filename', 'Report')}", expanded=False):
+            seen_keys = {}
+            for record in reversed(st.session_state.clinical_history):
+                if st.toggle(f"📋 {record['timestamp']} - {record.get('filename', 'Report')}", key=_entry_key("hist_report", record, seen_keys)):
                     st.json(record['data'])
-            
-            if st.button("🗑️ Clear All Reports", key="clear_reports"):
-                st.session_state.clinical_history = []
-                st.session_state.clinical_data = None
-                st.rerun()
+
+            st.button("🗑️ Clear All Reports", key="clear_reports", on_click=_clear_reports)
         else:
             st.caption("No reports uploaded yet.")
-    
+
     with col_h2:
         st.markdown("#### 🥗 Recipe Suggestions")
         if st.session_state.recipe_history:
-            for i, rec in enumerate(reversed(st.session_state.recipe_history)):
+            seen_keys = {}
+            for rec in reversed(st.session_state.recipe_history):
                 meal_type = rec.get('meal', 'Meal')
                 timestamp = rec['timestamp'][:10]
-                with st.expander(f"🍽️ {meal_type} - {timestamp}", expanded=False):
+                if st.toggle(f"🍽️ {meal_type} - {timestamp}", key=_entry_key("hist_recipe", rec, seen_keys)):
                     st.markdown(rec.get('content', ''))
-            
-            if st.button("🗑️ Clear Recipe History", key="clear_recipes"):
-                st.session_state.recipe_history = []
-                st.rerun()
+
+            st.button("🗑️ Clear Recipe History", key="clear_recipes", on_click=_clear_recipes)
         else:
             st.caption("No recipes generated yet.")
-    
+
     with col_h3:
         st.markdown("#### 🔍 Product Scans")
         if st.session_state.product_scan_history:
-            for i, scan in enumerate(reversed(st.session_state.product_scan_history)):
+            seen_keys = {}
+            for scan in reversed(st.session_state.product_scan_history):
                 barcode_label = scan.get('barcode') or 'Visual Scan'
                 timestamp = scan['timestamp'][:10]
-                with st.expander(f"🏷️ {barcode_label} - {timestamp}", expanded=False):
+                if st.toggle(f"🏷️ {barcode_label} - {timestamp}", key=_entry_key("hist_scan", scan, seen_keys)):
                     st.markdown(scan['analysis'])
-            
-            if st.button("🗑️ Clear Scan History", key="clear_scans"):
-                st.session_state.product_scan_history = []
-                st.rerun()
+
+            st.button("🗑️ Clear Scan History", key="clear_scans", on_click=_clear_scans)
         else:
             st.caption("No products scanned yet.")
     
@@ -916,36 +1736,44 @@ with tab4:
     
     with col_exp1:
         if st.session_state.clinical_history:
-            export_data = json.dumps(st.session_state.clinical_history, indent=2, default=str)
             st.download_button(
                 label="📥 Download Medical Data",
-                data=export_data,
+                data=export_json(list(st.session_state.clinical_history)),
                 file_name=f"medical_history_{datetime.now().strftime('%Y%m%d')}.json",
                 mime="application/json"
             )
-    
+
     with col_exp2:
         if st.session_state.recipe_history:
-            export_data = json.dumps(st.session_state.recipe_history, indent=2, default=str)
             st.download_button(
                 label="📥 Download Recipes",
-                data=export_data,
+                data=export_json(list(st.session_state.recipe_history)),
                 file_name=f"recipe_history_{datetime.now().strftime('%Y%m%d')}.json",
                 mime="application/json"
             )
-    
+
     with col_exp3:
         if st.session_state.product_scan_history:
-            export_data = json.dumps(st.session_state.product_scan_history, indent=2, default=str)
             st.download_button(
                 label="📥 Download Scans",
-                data=export_data,
+                data=export_json(list(st.session_state.product_scan_history)),
                 file_name=f"scan_history_{datetime.now().strftime('%Y%m%d')}.json",
                 mime="application/json"
             )
     
     st.markdown('</div>', unsafe_allow_html=True)
 
+# Each tab body is a fragment: a widget event inside one tab reruns
+# only that tab's function instead of the whole script.
+with tab1:
+    render_medical()
+with tab2:
+    render_fridge()
+with tab3:
+    render_product()
+with tab4:
+    render_history()
+
 # --------------------------------------------------
 # FOOTER
 # --------------------------------------------------
@@ -1,12 +1,34 @@
 import streamlit as st
+import hashlib
+import hmac
 import json
 import re
 from google import genai
-from PIL import Image
-from pypdf import PdfReader
 from datetime import datetime
 import os
-import pandas as pd
+
+# PIL, pandas, and the PDF backends are imported lazily inside the
+# functions that need them: every rerun re-executes this module, and the
+# login screen shouldn't pay ~100-300ms of import cost for libraries it
+# never touches.
+
+# orjson serializes/parses several times faster than stdlib json and is
+# already a requirement; fall back to stdlib so a missing wheel degrades
+# gracefully. orjson.JSONDecodeError subclasses json.JSONDecodeError, so
+# except clauses keep working either way.
+try:
+    import orjson
+
+    def jdumps(obj, indent=False):
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(obj, default=str, option=option).decode()
+
+    jloads = orjson.loads
+except ImportError:
+    def jdumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None, default=str)
+
+    jloads = json.loads
 
 # PAGE CONFIG
 st.set_page_config(
@@ -17,83 +39,254 @@ st.set_page_config(
 )
 
 # CUSTOM CSS
-st.markdown("""
-<style>
-    .main-header {
-        font-size: 2.8rem;
-        font-weight: bold;
-        text-align: center;
-        background: linear-gradient(120deg, #667eea 0%, #764ba2 100%);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-        padding: 1rem 0;
-        margin-bottom: 0.5rem;
-    }
-    .subtitle {
-        text-align: center;
-        color: #666;
-        font-size: 1rem;
-        font-style: italic;
-        margin-bottom: 2rem;
-    }
-    .info-card {
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        padding: 1.5rem;
-        border-radius: 15px;
-        color: white;
-        margin: 1rem 0;
-    }
-    .stButton>button {
-        width: 100%;
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        color: white;
-        border-radius: 10px;
-        font-weight: bold;
-        border: none;
-        transition: all 0.3s;
-    }
-    .stButton>button:hover {
-        transform: scale(1.02);
-        box-shadow: 0 5px 20px rgba(102, 126, 234, 0.4);
-    }
-    .section-header {
-        font-size: 1.5rem;
-        font-weight: 600;
-        color: #667eea;
-        margin-top: 1.5rem;
-        margin-bottom: 1rem;
-        border-bottom: 2px solid #667eea;
-        padding-bottom: 0.5rem;
-    }
-</style>
-""", unsafe_allow_html=True)
+# Rules live in static/helios.css, served via Streamlit static serving
+# (see .streamlit/config.toml). The browser caches the stylesheet, so
+# each rerun ships this one-line link instead of the full rule block.
+# The link is re-emitted every rerun on purpose: Streamlit drops
+# elements that are not re-rendered.
+st.markdown('<link rel="stylesheet" href="./app/static/helios.css">', unsafe_allow_html=True)
 
 # HELPER FUNCTIONS
+# Compiled once at import; these run on every analysis and every rerun,
+# so recompiling the patterns per call is wasted work.
+_NUM_RE = re.compile(r"[-+]?\d*\.\d+|\d+")
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*")
+_JSON_OBJ_RE = re.compile(r"\{[\s\S]*\}")
+
 def extract_numeric(text):
-    match = re.search(r"[-+]?\d*\.\d+|\d+", str(text))
+    """Scalar fallback; DataFrame columns use the vectorized
+    str.extract pass in build_marker_frame instead."""
+    match = _NUM_RE.search(str(text))
     return float(match.group()) if match else None
 
+USER_STORE = "users.jsonl"
+
+def _hash_password(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, n=2**14, r=8, p=1)
+
 def load_users():
-    if os.path.exists("users.json"):
+    users = {}
+    # One-time migration of the old plaintext users.json store.
+    if not os.path.exists(USER_STORE) and os.path.exists("users.json"):
         try:
             with open("users.json") as f:
-                return json.load(f)
+                legacy = json.load(f)
         except json.JSONDecodeError:
-            return {}
-    return {}
+            legacy = {}
+        for name, password in legacy.items():
+            append_user(name, password)
+        os.replace("users.json", "users.json.migrated")
+    if os.path.exists(USER_STORE):
+        with open(USER_STORE) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = jloads(line)
+                users[record["name"]] = record
+    return users
+
+@st.cache_resource
+def _users_store():
+    """Read the user table once per process.
+
+    Streamlit reruns the whole script on every keystroke in the login
+    form; the cached dict is shared across reruns so the file isn't
+    re-read and re-parsed each time. append_user writes new accounts
+    through to disk.
+    """
+    return load_users()
 
-def save_users(users):
-    with open("users.json", "w") as f:
-        json.dump(users, f)
+def append_user(name, password):
+    salt = os.urandom(16)
+    record = {
+        "name": name,
+        "salt": salt.hex(),
+        "hash": _hash_password(password, salt).hex(),
+    }
+    # Append-only: adding an account is a single short write instead of
+    # rewriting the whole store.
+    with open(USER_STORE, "a") as f:
+        f.write(jdumps(record) + "\n")
+    return record
+
+def verify_user(users, name, password):
+    record = users.get(name)
+    if record is None:
+        return False
+    expected = bytes.fromhex(record["hash"])
+    candidate = _hash_password(password, bytes.fromhex(record["salt"]))
+    return hmac.compare_digest(expected, candidate)
 
 def clean_json_response(text):
-    clean = re.sub(r"```json\s*", "", text)
-    clean = re.sub(r"```\s*", "", clean)
+    clean = _JSON_FENCE_RE.sub("", text)
     clean = clean.strip()
-    json_match = re.search(r'\{[\s\S]*\}', clean)
+    json_match = _JSON_OBJ_RE.search(clean)
     if json_match:
         clean = json_match.group()
-    return json.loads(clean)
+    return jloads(clean)
+
+def prep_image(img):
+    """Downscale and JPEG-re-encode an image before sending to Gemini.
+
+    Phone photos can be 12-24 MP and several MB; upload time and vision
+    tokens both scale with pixel count, and the model downsamples
+    internally anyway. 1024px longest edge at JPEG quality 85 cuts the
+    payload roughly 10x with no practical loss for this use.
+    """
+    import io
+    from PIL import Image
+
+    im = img.copy()
+    im.thumbnail((1024, 1024), Image.LANCZOS)
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    buf.seek(0)
+    return Image.open(buf)
+
+@st.cache_data(show_spinner=False)
+def decode_image(raw):
+    """Decode and downscale an uploaded image, memoized on its bytes.
+
+    Streamlit reruns the whole script on every widget interaction;
+    without this, each rerun re-runs the libjpeg decode and the JPEG
+    re-encode for every still-attached upload. st.cache_data keys on
+    the raw bytes, so repeats are dict lookups.
+    """
+    import io
+    from PIL import Image
+
+    return prep_image(Image.open(io.BytesIO(raw)))
+
+@st.cache_data(show_spinner=False)
+def decode_thumb(raw, size=128):
+    """Preview image at the given longest edge, memoized on the bytes.
+
+    Previews re-render on every widget interaction and Streamlit
+    re-encodes whatever image it is handed for the browser; encoding a
+    small thumb is trivial next to pushing the 1024px analysis copies
+    through that path on each rerun. The grid uses the 128px default;
+    single full-width previews pass a larger size so they stay sharp.
+    """
+    import io
+    from PIL import Image
+
+    im = Image.open(io.BytesIO(raw))
+    im.draft("RGB", (size * 2, size * 2))
+    im.thumbnail((size, size), Image.BILINEAR)
+    return im.convert("RGB")
+
+@st.cache_data(show_spinner=False)
+def barcode_for(_client, model_id, raw):
+    """Read a product image's barcode at most once per distinct upload.
+
+    The barcode check sits on the render path of the scanner column, so
+    without memoization every rerun (picking focus areas, pressing
+    Analyze) repeated the Gemini barcode call for the same image.
+    """
+    return get_barcode_via_ai(_client, model_id, decode_image(raw))
+
+# Pool-spawn plus per-worker re-parse costs more than it saves on short
+# documents, so only PDFs above this page count fan out across processes.
+POOL_MIN_PAGES = 20
+
+def _extract_page_block(raw_bytes, start, stop):
+    """Extract text for a half-open page span; runs in a worker process.
+
+    Module-level so ProcessPoolExecutor can pickle it. Each worker opens
+    its own document from the raw bytes — PDF pages are independent, so
+    blocks need no coordination.
+    """
+    try:
+        import fitz
+    except ImportError:
+        import io
+        from pypdf import PdfReader
+
+        reader = PdfReader(io.BytesIO(raw_bytes))
+        return "\n".join(reader.pages[i].extract_text() or "" for i in range(start, stop))
+    with fitz.open(stream=raw_bytes, filetype="pdf") as doc:
+        return "\n".join(doc[i].get_text("text") for i in range(start, stop))
+
+@st.cache_data(show_spinner=False)
+def extract_pdf_text(raw_bytes):
+    """Extract text from PDF bytes, memoized on the content.
+
+    PyMuPDF's extractor runs in C (MuPDF) and is roughly an order of
+    magnitude faster than pypdf's pure-Python content-stream interpreter
+    on typical lab reports; pypdf stays as the fallback when PyMuPDF is
+    not installed. st.cache_data keys on the bytes, so widget reruns and
+    repeat analyses of the same upload skip the parse entirely. Long
+    documents additionally split into one page block per CPU and extract
+    in parallel worker processes.
+    """
+    try:
+        import fitz
+    except ImportError:
+        import io
+        from pypdf import PdfReader
+
+        n_pages = len(PdfReader(io.BytesIO(raw_bytes), strict=False).pages)
+    else:
+        with fitz.open(stream=raw_bytes, filetype="pdf") as doc:
+            n_pages = doc.page_count
+
+    if n_pages <= POOL_MIN_PAGES:
+        return _extract_page_block(raw_bytes, 0, n_pages)
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = min(os.cpu_count() or 1, max(1, n_pages // POOL_MIN_PAGES))
+    step = -(-n_pages // workers)
+    spans = [(i, min(i + step, n_pages)) for i in range(0, n_pages, step)]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        blocks = ex.map(_extract_page_block, [raw_bytes] * len(spans),
+                        [s for s, _ in spans], [e for _, e in spans])
+        return "\n".join(blocks)
+
+@st.cache_data(show_spinner=False)
+def analyze_report(_client, model_id, prompt, content):
+    """Run the extraction prompt over a report, memoized on its text.
+
+    Re-analyzing an unchanged report (a common flow: upload, analyze,
+    wander off to another tab, come back and click again) becomes a
+    cache lookup instead of a repeated token-billed Gemini call. The
+    client is underscore-prefixed so Streamlit doesn't try to hash it.
+    """
+    response = _client.models.generate_content(model=model_id, contents=[prompt, content])
+    return clean_json_response(response.text)
+
+@st.cache_data
+def build_marker_frame(history):
+    """Flatten clinical history into a long-form marker DataFrame.
+
+    Keyed on the history entries themselves: the cache is shared across
+    sessions, so a bare length key would hand one user's marker frame
+    to another user with the same number of reports. Widget reruns with
+    an unchanged history still skip the pandas flatten.
+    """
+    import pandas as pd
+
+    if not history:
+        return pd.DataFrame(columns=["Date", "Marker", "Value"])
+    # json_normalize + melt keeps the per-marker inner loop inside
+    # pandas' C routines; Python only iterates once per report entry.
+    wide = pd.json_normalize(
+        [entry["data"].get("lab_markers", {}) for entry in history],
+        max_level=0,
+    )
+    # All tabs write ISO-8601 timestamps, so pandas parses the column in
+    # one vectorized pass instead of per-value format inference.
+    wide["Date"] = pd.to_datetime(
+        [entry["timestamp"] for entry in history], errors="coerce"
+    )
+    df = wide.melt(id_vars="Date", var_name="Marker", value_name="Raw")
+    df = df.dropna(subset=["Raw"])
+    if not df.empty:
+        df["Marker"] = df["Marker"].str.lower().str.strip()
+        df["Value"] = df["Raw"].astype(str).str.extract(f"({_NUM_RE.pattern})")[0].astype(float)
+        df = df.dropna(subset=["Value"])
+    return df
 
 def get_barcode_via_ai(client, model_id, image):
     try:
@@ -112,7 +305,7 @@ Return format: Just the barcode number or "NONE" """
         return None
 
 # LOGIN LOGIC
-users = load_users()
+users = _users_store()
 
 if 'username' not in st.session_state:
     st.markdown('<h1 class="main-header">HELIOS</h1>', unsafe_allow_html=True)
@@ -134,7 +327,7 @@ if 'username' not in st.session_state:
             if st.button("Login", type="primary", use_container_width=True):
                 if not username or not password:
                     st.error("Please enter both username and password.")
-                elif username in users and users[username] == password:
+                elif verify_user(users, username, password):
                     st.session_state.username = username
                     st.rerun()
                 else:
@@ -149,8 +342,7 @@ if 'username' not in st.session_state:
                 elif len(password) < 4:
                     st.warning("Password must be at least 4 characters.")
                 else:
-                    users[username] = password
-                    save_users(users)
+                    users[username] = append_user(username, password)
                     st.success("Account created successfully! Please login.")
         
         st.markdown("---")
@@ -165,13 +357,21 @@ if 'username' not in st.session_state:
     st.stop()
 
 # GEMINI INITIALIZATION
+@st.cache_resource
+def get_client():
+    """Build the Gemini client once per process.
+
+    genai.Client sets up HTTP connection pools on construction; doing
+    that on every rerun pays the setup cost and drops warm connections
+    each time a widget changes.
+    """
+    return genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
+
 try:
-    API_KEY = st.secrets["GEMINI_API_KEY"]
+    client = get_client()
 except KeyError:
     st.error("GEMINI_API_KEY not found in secrets. Please add it to your Streamlit secrets.")
     st.stop()
-
-client = genai.Client(api_key=API_KEY)
 MODEL_ID = "gemini-3-flash-preview"
 
 # SESSION STATE
@@ -248,8 +448,7 @@ with tab1:
             if uploaded_file.type == "text/plain":
                 content = uploaded_file.read().decode("utf-8")
             else:
-                reader = PdfReader(uploaded_file)
-                content = "\n".join(page.extract_text() or "" for page in reader.pages)
+                content = extract_pdf_text(uploaded_file.getvalue())
             
             if not content.strip():
                 st.error("Could not extract text from the file.")
@@ -274,12 +473,11 @@ Extract ALL lab values with units. If a field has no data, use empty list [] or
 Analyze this report:"""
                         
                         try:
-                            response = client.models.generate_content(model=MODEL_ID, contents=[prompt, content])
-                            extracted_data = clean_json_response(response.text)
+                            extracted_data = analyze_report(client, MODEL_ID, prompt, content)
                             
                             st.session_state.clinical_data = extracted_data
                             st.session_state.clinical_history.append({
-                                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                                "timestamp": datetime.now().isoformat(timespec="minutes"),
                                 "filename": uploaded_file.name,
                                 "data": extracted_data
                             })
@@ -345,18 +543,20 @@ with tab2:
         if input_mode == "Use Camera":
             cam_img = st.camera_input("Capture a photo of your kitchen inventory")
             if cam_img:
-                fridge_images = [Image.open(cam_img)]
+                fridge_images = [decode_image(cam_img.getvalue())]
                 st.success("Photo captured successfully")
         else:
             files = st.file_uploader("Upload photos of your kitchen", type=["jpg", "png", "jpeg"], accept_multiple_files=True, key="fridge_uploader")
             if files:
-                fridge_images = [Image.open(f) for f in files]
+                fridge_images = [decode_image(f.getvalue()) for f in files]
                 st.success(f"{len(files)} image(s) uploaded")
+                # Previews use 128px thumbs so reruns only re-encode tiny
+                # images; the 1024px copies go to the model, not st.image.
                 if len(fridge_images) <= 4:
-                    cols = st.columns(len(fridge_images))
-                    for i, img in enumerate(fridge_images):
+                    cols = st.columns(len(files))
+                    for i, f in enumerate(files):
                         with cols[i]:
-                            st.image(img, use_container_width=True)
+                            st.image(decode_thumb(f.getvalue()), use_container_width=True)
     
     with col_pref:
         st.markdown("### Preferences")
@@ -369,7 +569,7 @@ with tab2:
     if fridge_images:
         if st.button("Analyze & Generate Personalized Recipes", type="primary", use_container_width=True):
             with st.spinner("Analyzing ingredients..."):
-                prompt = f"""Analyze these kitchen images. User context: Health Profile: {json.dumps(st.session_state.clinical_data or {})}, Dietary: {", ".join(dietary) or "None"}, Cuisine: {", ".join(cuisine) or "Any"}, Meal: {meal}, Time: {cooking_time}
+                prompt = f"""Analyze these kitchen images. User context: Health Profile: {jdumps(st.session_state.clinical_data or {})}, Dietary: {", ".join(dietary) or "None"}, Cuisine: {", ".join(cuisine) or "Any"}, Meal: {meal}, Time: {cooking_time}
 
 Provide:
 1. DETECTED INGREDIENTS - List all visible items
@@ -378,11 +578,13 @@ Provide:
 4. PERSONALIZED RECIPES (3) - Name, Time, Difficulty, Ingredients (available vs need), Instructions, Health Benefits"""
                 
                 try:
-                    response = client.models.generate_content(model=MODEL_ID, contents=[prompt] + fridge_images)
+                    stream = client.models.generate_content_stream(model=MODEL_ID, contents=[prompt] + fridge_images)
                     st.markdown("---")
                     st.markdown("## Personalized Kitchen Analysis")
-                    st.markdown(response.text)
-                    st.session_state.recipe_history.append({"timestamp": datetime.now().isoformat(), "meal": meal, "cuisines": cuisine, "content": response.text})
+                    # Render chunks as they arrive so the first lines show
+                    # up in ~1s instead of after the full generation.
+                    analysis_text = st.write_stream(chunk.text for chunk in stream if chunk.text)
+                    st.session_state.recipe_history.append({"timestamp": datetime.now().isoformat(timespec="minutes"), "meal": meal, "cuisines": cuisine, "content": analysis_text})
                     st.success("Analysis saved to history")
                 except Exception as e:
                     st.error(f"Analysis failed: {str(e)}")
@@ -406,20 +608,23 @@ with tab3:
         st.markdown("### Product Capture")
         scan_mode = st.radio("Input Method:", ["Upload Image", "Use Camera"], horizontal=True, key="product_scan_mode")
         product_image = None
-        
+        product_raw = None
+
         if scan_mode == "Use Camera":
             cam_shot = st.camera_input("Capture product label")
             if cam_shot:
-                product_image = Image.open(cam_shot)
+                product_raw = cam_shot.getvalue()
+                product_image = decode_image(product_raw)
         else:
             uploaded_product = st.file_uploader("Upload product label", type=["jpg", "png", "jpeg"], key="product_uploader")
             if uploaded_product:
-                product_image = Image.open(uploaded_product)
-        
+                product_raw = uploaded_product.getvalue()
+                product_image = decode_image(product_raw)
+
         if product_image:
-            st.image(product_image, caption="Product Image", use_container_width=True)
+            st.image(decode_thumb(product_raw, size=512), caption="Product Image", use_container_width=True)
             with st.spinner("Checking for barcode..."):
-                barcode_id = get_barcode_via_ai(client, MODEL_ID, product_image)
+                barcode_id = barcode_for(client, MODEL_ID, product_raw)
                 if barcode_id:
                     st.success(f"Barcode Detected: `{barcode_id}`")
                 else:
@@ -433,7 +638,7 @@ with tab3:
         if product_image:
             if st.button("Analyze Product", type="primary", use_container_width=True):
                 with st.spinner("Analyzing product..."):
-                    prompt = f"""Analyze this food product. Context: Health Profile: {json.dumps(st.session_state.clinical_data or {})}, Focus: {", ".join(analysis_focus) or "All"}
+                    prompt = f"""Analyze this food product. Context: Health Profile: {jdumps(st.session_state.clinical_data or {})}, Focus: {", ".join(analysis_focus) or "All"}
 
 Provide:
 1. PRODUCT IDENTIFICATION
@@ -445,9 +650,9 @@ Provide:
 7. CONSUMER TIPS"""
                     
                     try:
-                        response = client.models.generate_content(model=MODEL_ID, contents=[prompt, product_image])
-                        st.markdown(response.text)
-                        st.session_state.product_scan_history.append({"timestamp": datetime.now().isoformat(), "barcode": barcode_id, "analysis": response.text})
+                        stream = client.models.generate_content_stream(model=MODEL_ID, contents=[prompt, product_image])
+                        analysis_text = st.write_stream(chunk.text for chunk in stream if chunk.text)
+                        st.session_state.product_scan_history.append({"timestamp": datetime.now().isoformat(timespec="minutes"), "barcode": barcode_id, "analysis": analysis_text})
                         st.success("Analysis saved to history")
                     except Exception as e:
                         st.error(f"Analysis failed: {str(e)}")
@@ -556,22 +761,9 @@ with tab4:
     st.markdown("###  Lab Marker Trends")
     
     if st.session_state.clinical_history:
-        # Prepare data for charting
-        all_markers = []
-        for entry in st.session_state.clinical_history:
-            date = entry["timestamp"]
-            markers = entry["data"].get("lab_markers", {})
-            for m_name, m_val in markers.items():
-                num_val = extract_numeric(m_val)
-                if num_val is not None:
-                    all_markers.append({
-                        "Date": date, 
-                        "Marker": m_name.lower().strip(), 
-                        "Value": num_val
-                    })
-        
-        if all_markers:
-            df = pd.DataFrame(all_markers)
+        df = build_marker_frame(st.session_state.clinical_history)
+
+        if not df.empty:
             unique_markers = sorted(df["Marker"].unique())
             
             col_select, col_info = st.columns([2, 1])
@@ -698,7 +890,7 @@ with tab4:
     
     with col_exp1:
         if st.session_state.clinical_history:
-            export_data = json.dumps(st.session_state.clinical_history, indent=2, default=str)
+            export_data = jdumps(st.session_state.clinical_history, indent=True)
             st.download_button(
                 label="Download Medical Data",
                 data=export_data,
@@ -708,7 +900,7 @@ with tab4:
     
     with col_exp2:
         if st.session_state.recipe_history:
-            export_data = json.dumps(st.session_state.recipe_history, indent=2, default=str)
+            export_data = jdumps(st.session_state.recipe_history, indent=True)
             st.download_button(
                 label="Download Recipes",
                 data=export_data,
@@ -718,7 +910,7 @@ with tab4:
     
     with col_exp3:
         if st.session_state.product_scan_history:
-            export_data = json.dumps(st.session_state.product_scan_history, indent=2, default=str)
+            export_data = jdumps(st.session_state.product_scan_history, indent=True)
             st.download_button(
                 label="Download Scans",
                 data=export_data,